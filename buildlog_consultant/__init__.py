@@ -36,7 +36,7 @@ class Problem(object):
         raise NotImplementedError(self.json)
 
 
-def problem(kind, is_global=False):
+def problem(kind, is_global=False, frozen=False):
     def json(self):
         ret = {}
         for name in self.__dataclass_fields__:
@@ -47,10 +47,19 @@ def problem(kind, is_global=False):
     def from_json(cls, data):
         return cls(**data)
 
+    def __reduce__(self):
+        # Frozen instances can not be restored by setting their slots.
+        return (
+            type(self),
+            tuple(getattr(self, name) for name in self.__dataclass_fields__),
+        )
+
     def _wrap(cls):
-        ret = dataclass(cls)
+        ret = dataclass(cls, frozen=frozen)
         ret.kind = kind
         ret.is_global = is_global
+        if frozen:
+            ret.__reduce__ = __reduce__
         if not hasattr(ret, 'json'):
             ret.json = json
         if not hasattr(ret, 'from_json'):
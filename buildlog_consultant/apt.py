@@ -16,6 +16,9 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import bisect
+import functools
+import itertools
 import re
 
 from debian.changelog import Version
@@ -23,105 +26,135 @@ from debian.deb822 import PkgRelation
 from typing import List, Optional, Tuple
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader  # type: ignore
+
 from . import Problem, SingleLineMatch, problem
 from .common import NoSpaceOnDevice
 
 
-class DpkgError(Problem):
+# Patterns for the interesting lines near the end of apt-get output, keyed
+# by the literal prefix they share. They are combined into a single
+# alternation that is factored on those prefixes and anchored at the start
+# of each line, so that the tail of the output can be scanned in one pass of
+# the regex engine; the name of the outer group identifies which pattern
+# matched.
+_APT_FAILURE_PATTERNS = {
+    "E: ": [
+        # The URL and error message are split off with string operations.
+        ("fetch", r"Failed to fetch "),
+        (
+            "missing_release",
+            r"The repository '(?P<release_url>[^'\n]+)' does not have a Release "
+            r"file\.",
+        ),
+        ("free_space", r"You don't have enough free space in .*\."),
+        ("unknown_package", r"Unable to locate package (?P<package>.*)"),
+        ("write_error", r"Write error - write \(28: No space left on device\)$"),
+        # Any other error.
+        ("other", r""),
+    ],
+    "dpkg-deb: error: ": [
+        ("deb_no_space", r"unable to write file '.*': No space left on device"),
+    ],
+    "dpkg: error": [
+        ("dpkg_error", r": (?P<dpkg_message>.*)"),
+        # The package and stage are split off with string operations.
+        ("dpkg_processing", r" processing package "),
+    ],
+}
+_APT_FAILURE_RE = re.compile(
+    "^(?:%s)"
+    % "|".join(
+        "%s(?:%s)"
+        % (
+            re.escape(prefix),
+            "|".join(f"(?P<{name}>{pattern})" for (name, pattern) in patterns),
+        )
+        for (prefix, patterns) in _APT_FAILURE_PATTERNS.items()
+    ),
+    re.MULTILINE,
+)
 
-    kind = "dpkg-error"
+# Lines emitted by apt when it can not resolve dependencies; the actual
+# problem is described on the line before.
+_BROKEN_PACKAGES_LINES = frozenset(
+    [
+        "E: Broken packages",
+        "E: Unable to correct problems, you have held broken packages.",
+    ]
+)
+_RE_COPY_NOSPACE = re.compile(
+    r" cannot copy extracted data for '(.*)' to "
+    r"'(.*)': failed to write \(No space left on device\)"
+)
+_RE_TAIL_NOSPACE = re.compile(r" .*: No space left on device")
 
-    def __init__(self, error):
-        self.error = error
 
-    def __eq__(self, other):
-        return isinstance(other, type(self)) and self.error == other.error
+@problem("dpkg-error", frozen=True)
+class DpkgError:
 
-    def __str__(self):
-        return "Dpkg Error: %s" % self.error
+    __slots__ = ("error",)
 
-    def __repr__(self):
-        return "%s(%r)" % (type(self).__name__, self.error)
+    error: str
+
+    def __str__(self):
+        return f"Dpkg Error: {self.error}"
 
 
-class AptUpdateError(Problem):
+@problem("apt-update-error", frozen=True)
+class AptUpdateError:
     """Apt update error."""
 
-    kind = "apt-update-error"
+    __slots__ = ()
 
 
+@problem("apt-file-fetch-failure", frozen=True)
 class AptFetchFailure(AptUpdateError):
     """Apt file fetch failed."""
 
-    kind = "apt-file-fetch-failure"
+    __slots__ = ("url", "error")
 
-    def __init__(self, url, error):
-        self.url = url
-        self.error = error
-
-    def __eq__(self, other):
-        if not isinstance(other, type(self)):
-            return False
-        if self.url != other.url:
-            return False
-        if self.error != other.error:
-            return False
-        return True
+    url: Optional[str]
+    error: str
 
     def __str__(self):
-        return "Apt file fetch error: %s" % self.error
+        return f"Apt file fetch error: {self.error}"
 
 
+@problem("missing-release-file", frozen=True)
 class AptMissingReleaseFile(AptUpdateError):
 
-    kind = "missing-release-file"
-
-    def __init__(self, url):
-        self.url = url
+    __slots__ = ("url",)
 
-    def __eq__(self, other):
-        if not isinstance(other, type(self)):
-            return False
-        if self.url != self.url:
-            return False
-        return True
+    url: str
 
     def __str__(self):
-        return "Missing release file: %s" % self.url
+        return f"Missing release file: {self.url}"
 
 
-class AptPackageUnknown(Problem):
+@problem("apt-package-unknown", frozen=True)
+class AptPackageUnknown:
 
-    kind = "apt-package-unknown"
+    __slots__ = ("package",)
 
-    def __init__(self, package):
-        self.package = package
-
-    def __eq__(self, other):
-        return isinstance(other, type(self)) and self.package == other.package
+    package: str
 
     def __str__(self):
-        return "Unknown package: %s" % self.package
+        return f"Unknown package: {self.package}"
 
-    def __repr__(self):
-        return "%s(%r)" % (type(self).__name__, self.package)
 
+@problem("apt-broken-packages", frozen=True)
+class AptBrokenPackages:
 
-class AptBrokenPackages(Problem):
+    __slots__ = ("description",)
 
-    kind = "apt-broken-packages"
-
-    def __init__(self, description):
-        self.description = description
+    description: str
 
     def __str__(self):
-        return "Broken apt packages: %s" % (self.description,)
-
-    def __repr__(self):
-        return "%s(%r)" % (type(self).__name__, self.description)
-
-    def __eq__(self, other):
-        return isinstance(other, type(self)) and self.description == other.description
+        return f"Broken apt packages: {self.description}"
 
 
 def find_apt_get_failure(lines):  # noqa: C901
@@ -132,70 +165,92 @@ def find_apt_get_failure(lines):  # noqa: C901
     """
     ret = (None, None)
     OFFSET = 50
-    for i in range(1, OFFSET):
-        lineno = len(lines) - i
-        if lineno < 0:
-            break
-        line = lines[lineno].strip("\n")
-        if line.startswith("E: Failed to fetch "):
-            m = re.match("^E: Failed to fetch ([^ ]+)  (.*)", line)
-            if m:
-                if "No space left on device" in m.group(2):
-                    problem = NoSpaceOnDevice()
-                else:
-                    problem = AptFetchFailure(m.group(1), m.group(2))
-                return SingleLineMatch.from_lines(lines, lineno), problem
-            return SingleLineMatch.from_lines(lines, lineno), None
-        if line in (
-            "E: Broken packages",
-            "E: Unable to correct problems, you have held broken " "packages.",
-        ):
-            error = AptBrokenPackages(lines[lineno - 1].strip())
-            return SingleLineMatch.from_lines(lines, lineno - 1), error
-        m = re.match("E: The repository '([^']+)' does not have a Release file.", line)
-        if m:
-            return SingleLineMatch.from_lines(lines, lineno), AptMissingReleaseFile(
-                m.group(1)
+    tail = [line.rstrip("\n") for line in lines[-OFFSET:]]
+    base = len(lines) - len(tail)
+    text = "\n".join(tail)
+    # Find all candidate lines in one pass, then pick the last one that
+    # actually describes a failure. Most output has no apt or dpkg errors
+    # at all, in which case there is no point in running the regex or
+    # working out where each line starts.
+    if "E: " in text or "dpkg" in text:
+        matches = list(_APT_FAILURE_RE.finditer(text))
+    else:
+        matches = []
+    starts = []
+    if matches:
+        offset = 0
+        for line in tail:
+            starts.append(offset)
+            offset += len(line) + 1
+    for m in reversed(matches):
+        idx = bisect.bisect_right(starts, m.start()) - 1
+        lineno = base + idx
+        line = tail[idx]
+        kind = m.lastgroup
+        if kind == "other":
+            if line in _BROKEN_PACKAGES_LINES:
+                # The line before describes what is broken.
+                description = lines[lineno - 1]
+                return (
+                    SingleLineMatch(lineno - 1, description),
+                    AptBrokenPackages(description.strip()),
+                )
+            if ret[0] is None:
+                ret = SingleLineMatch.from_lines(lines, lineno), None
+            continue
+        if kind == "fetch":
+            # E: Failed to fetch URL  ERROR
+            url, sep, error = line[m.end() - starts[idx]:].partition("  ")
+            if not sep or not url or " " in url:
+                return SingleLineMatch.from_lines(lines, lineno), None
+            if "No space left on device" in error:
+                problem = NoSpaceOnDevice()
+            else:
+                problem = AptFetchFailure(url, error)
+            return SingleLineMatch.from_lines(lines, lineno), problem
+        if kind == "missing_release":
+            return (
+                SingleLineMatch.from_lines(lines, lineno),
+                AptMissingReleaseFile(m.group("release_url")),
             )
-        m = re.match(
-            "dpkg-deb: error: unable to write file '(.*)': " "No space left on device",
-            line,
-        )
-        if m:
-            return SingleLineMatch.from_lines(lines, lineno), NoSpaceOnDevice()
-        m = re.match(r"E: You don't have enough free space in (.*)\.", line)
-        if m:
+        if kind in ("free_space", "write_error", "deb_no_space"):
             return SingleLineMatch.from_lines(lines, lineno), NoSpaceOnDevice()
-        if line.startswith("E: ") and ret[0] is None:
-            ret = SingleLineMatch.from_lines(lines, lineno), None
-        m = re.match(r"E: Unable to locate package (.*)", line)
-        if m:
-            return SingleLineMatch.from_lines(lines, lineno), AptPackageUnknown(
-                m.group(1)
+        if kind == "unknown_package":
+            return (
+                SingleLineMatch.from_lines(lines, lineno),
+                AptPackageUnknown(m.group("package")),
             )
-        if line == "E: Write error - write (28: No space left on device)":
-            return SingleLineMatch.from_lines(lines, lineno), NoSpaceOnDevice()
-        m = re.match(r"dpkg: error: (.*)", line)
-        if m:
-            if m.group(1).endswith(": No space left on device"):
+        if kind == "dpkg_error":
+            message = m.group("dpkg_message")
+            if message.endswith(": No space left on device"):
                 return SingleLineMatch.from_lines(lines, lineno), NoSpaceOnDevice()
-            return SingleLineMatch.from_lines(lines, lineno), DpkgError(m.group(1))
-        m = re.match(r"dpkg: error processing package (.*) \((.*)\):", line)
-        if m:
+            return SingleLineMatch.from_lines(lines, lineno), DpkgError(message)
+        if kind == "dpkg_processing":
+            # dpkg: error processing package PACKAGE (STAGE):
+            rest = line[m.end() - starts[idx]:]
+            end = rest.rfind("):")
+            if end == -1:
+                continue
+            package, sep, stage = rest[:end].rpartition(" (")
+            if not sep:
+                continue
             return (
                 SingleLineMatch.from_lines(lines, lineno + 1),
-                DpkgError("processing package %s (%s)" % (m.group(1), m.group(2))),
+                DpkgError(f"processing package {package} ({stage})"),
             )
 
+    # Most logs never mention running out of space, so check the whole
+    # output with a single substring search before looking at each line.
+    if "No space left on device" not in "\n".join(lines):
+        return ret
+
     for i, line in enumerate(lines):
-        m = re.match(
-            r" cannot copy extracted data for '(.*)' to "
-            r"'(.*)': failed to write \(No space left on device\)",
-            line,
-        )
+        if "No space left on device" not in line:
+            continue
+        m = _RE_COPY_NOSPACE.match(line)
         if m:
-            return SingleLineMatch.from_lines(lines, lineno), NoSpaceOnDevice()
-        m = re.match(r" .*: No space left on device", line)
+            return SingleLineMatch.from_lines(lines, i), NoSpaceOnDevice()
+        m = _RE_TAIL_NOSPACE.match(line)
         if m:
             return SingleLineMatch.from_lines(lines, i), NoSpaceOnDevice()
 
@@ -209,18 +264,19 @@ def find_apt_get_update_failure(sbuildlog):
     return focus_section, match, error
 
 
+# A line that is empty or only contains whitespace, which ends the dose3
+# output.
+_CUDF_END_RE = re.compile(r"\n[^\S\n]*(?:\n|\Z)")
+
+
 def find_cudf_output(lines):
-    for i in range(len(lines) - 1, 0, -1):
-        if lines[i].startswith("output-version: "):
-            break
-    else:
+    text = "\n" + "\n".join(line.rstrip("\n") for line in lines)
+    start = text.rfind("\noutput-version: ")
+    if start == -1:
         return None
-    output = []
-    while lines[i].strip():
-        output.append(lines[i])
-        i += 1
-
-    return yaml.safe_load("\n".join(output))
+    m = _CUDF_END_RE.search(text, start + 1)
+    end = m.start() if m else len(text)
+    return yaml.load(text[start + 1:end], Loader=SafeLoader)
 
 
 try:
@@ -245,10 +301,12 @@ else:
 @problem("unsatisfied-apt-dependencies")
 class UnsatisfiedAptDependencies:
 
+    __slots__ = ("relations",)
+
     relations: List[List[List[ParsedRelation]]]
 
     def __str__(self):
-        return "Unsatisfied APT dependencies: %s" % PkgRelation.str(self.relations)
+        return f"Unsatisfied APT dependencies: {PkgRelation.str(self.relations)}"
 
     @classmethod
     def from_str(cls, text):
@@ -272,57 +330,92 @@ class UnsatisfiedAptDependencies:
         return cls(relations=relations)
 
     def __repr__(self):
-        return "%s.from_str(%r)" % (
-            type(self).__name__,
-            PkgRelation.str(self.relations),
-        )
+        return f"{type(self).__name__}.from_str({PkgRelation.str(self.relations)!r})"
 
 
 @problem("unsatisfied-apt-conflicts")
 class UnsatisfiedAptConflicts:
 
+    __slots__ = ("relations",)
+
     relations: List[List[List[ParsedRelation]]]
 
     def __str__(self):
-        return "Unsatisfied APT conflicts: %s" % PkgRelation.str(self.relations)
+        return f"Unsatisfied APT conflicts: {PkgRelation.str(self.relations)}"
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_dose3_relation(text):
+    # dose3 reports the same unsatisfied relation for many reasons in large
+    # reports, so only parse each distinct relation string once.
+    relation = PkgRelation.parse_relations(text)
+    for o in relation:
+        for d in o:
+            if d['version']:
+                try:
+                    newoperator = {'<': '<<', '>': '>>'}[d['version'][0]]
+                except KeyError:
+                    pass
+                else:
+                    d['version'] = (newoperator, d['version'][1])
+    return relation
+
+
+def parse_dose3_relation(text):
+    """Parse a relation from a dose3 report.
+
+    Returns:
+      relation as returned by PkgRelation.parse_relations, with dose3's
+      "<" and ">" operators converted to the Debian "<<" and ">>"
+    """
+    # Copy everything that is mutable, so that callers can not modify the
+    # cached result.
+    return [
+        [
+            {
+                'name': d['name'],
+                'archqual': d['archqual'],
+                'version': d['version'],
+                'arch': list(d['arch']) if d['arch'] is not None else None,
+                'restrictions': (
+                    [list(r) for r in d['restrictions']]
+                    if d['restrictions'] is not None else None),
+            }
+            for d in o
+        ]
+        for o in _parse_dose3_relation(text)
+    ]
 
 
 def error_from_dose3_report(report):
-    def fixup_relation(rel):
-        for o in rel:
-            for d in o:
-                if d['version']:
-                    try:
-                        newoperator = {'<': '<<', '>': '>>'}[d['version'][0]]
-                    except KeyError:
-                        pass
-                    else:
-                        d['version'] = (newoperator, d['version'][1])
     packages = [entry["package"] for entry in report]
     assert packages == ["sbuild-build-depends-main-dummy"]
     if report[0]["status"] != "broken":
         return None
-    missing = []
-    conflict = []
-    for reason in report[0]["reasons"]:
-        if "missing" in reason:
-            relation = PkgRelation.parse_relations(
-                reason["missing"]["pkg"]["unsat-dependency"]
-            )
-            fixup_relation(relation)
-            missing.extend(relation)
-        if "conflict" in reason:
-            relation = PkgRelation.parse_relations(
-                reason["conflict"]["pkg1"]["unsat-conflict"]
-            )
-            fixup_relation(relation)
-            conflict.extend(relation)
+    reasons = report[0]["reasons"]
+    missing = list(
+        itertools.chain.from_iterable(
+            parse_dose3_relation(reason["missing"]["pkg"]["unsat-dependency"])
+            for reason in reasons
+            if "missing" in reason
+        )
+    )
     if missing:
         return UnsatisfiedAptDependencies(missing)
+    conflict = list(
+        itertools.chain.from_iterable(
+            parse_dose3_relation(reason["conflict"]["pkg1"]["unsat-conflict"])
+            for reason in reasons
+            if "conflict" in reason
+        )
+    )
     if conflict:
         return UnsatisfiedAptConflicts(conflict)
 
 
+_INSTALL_DEPS_SECTION_RE = re.compile(r"install .* build dependencies")
+
+
 def find_install_deps_failure_description(sbuildlog) -> Tuple[Optional[str], Optional[SingleLineMatch], Optional[Problem]]:
     error = None
 
@@ -347,7 +440,10 @@ def find_install_deps_failure_description(sbuildlog) -> Tuple[Optional[str], Opt
     for section in sbuildlog.sections:
         if section.title is None:
             continue
-        if re.match("install (.*) build dependencies.*", section.title.lower()):
+        title = section.title.lower()
+        if not title.startswith("install "):
+            continue
+        if _INSTALL_DEPS_SECTION_RE.match(title):
             match, error = find_apt_get_failure(section.lines)
             if match is not None:
                 return section.title, match, error
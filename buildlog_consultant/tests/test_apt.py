@@ -15,13 +15,22 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import pickle
 import unittest
 
 from ..apt import (
+    AptBrokenPackages,
     AptFetchFailure,
     AptMissingReleaseFile,
+    AptPackageUnknown,
+    DpkgError,
+    UnsatisfiedAptDependencies,
+    error_from_dose3_report,
     find_apt_get_failure,
+    find_cudf_output,
+    parse_dose3_relation,
 )
+from ..common import NoSpaceOnDevice
 
 
 class FindAptGetFailureDescriptionTests(unittest.TestCase):
@@ -53,6 +62,9 @@ File has unexpected size (3385796 != 3385720). Mirror sync in progress? [IP]\
             ),
         )
 
+    def test_fetch_failure_unparseable(self):
+        self.run_test(["E: Failed to fetch http://x/ y  err"], 1, None)
+
     def test_missing_release_file(self):
         self.run_test(
             [
@@ -62,8 +74,177 @@ does not have a Release file.\
 """
             ],
             1,
-            AptMissingReleaseFile("http://janitor.debian.net/ blah/ Release"),
+            AptMissingReleaseFile("https://janitor.debian.net blah/ Release"),
         )
 
     def test_vague(self):
         self.run_test(["E: Stuff is broken"], 1, None)
+
+    def test_unknown_package(self):
+        self.run_test(
+            ["Reading package lists...", "E: Unable to locate package foo-dev"],
+            2,
+            AptPackageUnknown("foo-dev"),
+        )
+
+    def test_dpkg_error(self):
+        self.run_test(
+            ["dpkg: error: dpkg frontend lock is locked by another process"],
+            1,
+            DpkgError("dpkg frontend lock is locked by another process"),
+        )
+
+    def test_no_space_dpkg_deb(self):
+        self.run_test(
+            [
+                "dpkg-deb: error: unable to write file '/usr/lib/foo.so': "
+                "No space left on device"
+            ],
+            1,
+            NoSpaceOnDevice(),
+        )
+
+    def test_dpkg_processing_package(self):
+        self.run_test(
+            [
+                "dpkg: error processing package libfoo1 (--configure):",
+                " dependency problems - leaving unconfigured",
+            ],
+            2,
+            DpkgError("processing package libfoo1 (--configure)"),
+        )
+
+    def test_dpkg_processing_package_trailing_whitespace(self):
+        for suffix in [" \n", "\r\n"]:
+            self.run_test(
+                [
+                    "dpkg: error processing package libfoo1 (--configure):" + suffix,
+                    " dependency problems - leaving unconfigured\n",
+                ],
+                2,
+                DpkgError("processing package libfoo1 (--configure)"),
+            )
+
+    def test_broken_packages(self):
+        self.run_test(
+            [
+                " libfoo-dev : Depends: libbar-dev but it is not going to be installed",
+                "E: Unable to correct problems, you have held broken packages.",
+            ],
+            1,
+            AptBrokenPackages(
+                "libfoo-dev : Depends: libbar-dev but it is not going to be installed"
+            ),
+        )
+
+    def test_no_space_copy_extracted_data(self):
+        self.run_test(
+            [
+                "Unpacking libfoo1 (1.0-1) ...",
+                "dpkg-deb (subprocess): cannot copy archive member",
+                " cannot copy extracted data for './usr/lib/libfoo.so.1' to "
+                "'/usr/lib/libfoo.so.1.dpkg-new': failed to write "
+                "(No space left on device)",
+                "Setting up libbar1 (1.0-1) ...",
+            ],
+            3,
+            NoSpaceOnDevice(),
+        )
+
+
+class FindCudfOutputTests(unittest.TestCase):
+    def test_dose3_report(self):
+        lines = [
+            "Solving dependencies....\n",
+            "output-version: 1.2\n",
+            "native-architecture: amd64\n",
+            "report:\n",
+            "  -\n",
+            "    package: sbuild-build-depends-main-dummy\n",
+            "    version: 0.invalid.0\n",
+            "    architecture: amd64\n",
+            "    status: broken\n",
+            "    reasons:\n",
+            "      -\n",
+            "        missing:\n",
+            "          pkg:\n",
+            "            package: sbuild-build-depends-main-dummy\n",
+            "            version: 0.invalid.0\n",
+            "            architecture: amd64\n",
+            "            unsat-dependency: libfoo-dev:amd64 (>= 1.2)\n",
+            "\n",
+            "E: Package installation failed\n",
+        ]
+        output = find_cudf_output(lines)
+        self.assertEqual("amd64", output["native-architecture"])
+        self.assertEqual(
+            UnsatisfiedAptDependencies.from_str("libfoo-dev:amd64 (>= 1.2)"),
+            error_from_dose3_report(output["report"]),
+        )
+
+    def test_no_output(self):
+        self.assertIs(None, find_cudf_output(["E: Package installation failed\n"]))
+
+    def test_whitespace_line_ends_output(self):
+        self.assertEqual(
+            {"output-version": 1.2, "report": []},
+            find_cudf_output(
+                [
+                    "output-version: 1.2\n",
+                    "report: []\n",
+                    " \n",
+                    "E: Package installation failed\n",
+                    "Not removing build depends: as requested\n",
+                ]
+            ),
+        )
+
+    def test_whitespace_last_line_ends_output(self):
+        self.assertEqual(
+            {"output-version": 1.2},
+            find_cudf_output(["a: 1\n", "output-version: 1.2\n", "\t\r\n"]),
+        )
+
+    def test_output_at_end(self):
+        self.assertEqual(
+            {"output-version": 1.2, "native-architecture": "amd64"},
+            find_cudf_output(
+                ["output-version: 1.2\n", "native-architecture: amd64\n"]
+            ),
+        )
+
+
+class ParseDose3RelationTests(unittest.TestCase):
+    def test_operator(self):
+        relation = parse_dose3_relation("libfoo-dev (< 2.0)")
+        self.assertEqual(("<<", "2.0"), relation[0][0]["version"])
+        relation[0][0]["version"] = None
+        self.assertEqual(
+            ("<<", "2.0"), parse_dose3_relation("libfoo-dev (< 2.0)")[0][0]["version"]
+        )
+
+    def test_independent_results(self):
+        text = "libfoo-dev:amd64 (< 1) [amd64] <!nocheck>"
+        relation = parse_dose3_relation(text)
+        relation[0][0]["arch"].append("MUT")
+        relation[0][0]["restrictions"].append("MUT")
+        relation[0][0]["restrictions"][0].append("MUT")
+        relation = parse_dose3_relation(text)
+        self.assertEqual(1, len(relation[0][0]["arch"]))
+        self.assertEqual(1, len(relation[0][0]["restrictions"]))
+        self.assertEqual(1, len(relation[0][0]["restrictions"][0]))
+
+
+class AptProblemTests(unittest.TestCase):
+    def test_hashable(self):
+        self.assertEqual(
+            {AptFetchFailure("http://example.com/", "Not found")},
+            {
+                AptFetchFailure("http://example.com/", "Not found"),
+                AptFetchFailure("http://example.com/", "Not found"),
+            },
+        )
+
+    def test_pickle(self):
+        problem = AptFetchFailure("http://example.com/", "Not found")
+        self.assertEqual(problem, pickle.loads(pickle.dumps(problem)))